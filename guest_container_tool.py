@@ -1,22 +1,70 @@
 #!/usr/bin/env python3
 
+import functools
 import json
 import os
-import re
 from argparse import ArgumentParser, Namespace
-from hashlib import sha512
 from pathlib import Path
-from shutil import copyfile, rmtree
-from socket import gethostname
+from shutil import rmtree
 from subprocess import check_call
+from typing import Optional
 
 ROOT_DIR = Path(__file__).parent.absolute()
 
-# the base port is a 10 digit wide default starting port for containers
-# it's based on the first 8 bytes (modulo 1000) of the sha512 hash of the hostname
-BASE_PORT = (
-    int.from_bytes(sha512(gethostname().encode("utf-8")).digest()[:8], "little") % 1000
-) * 10 + 32000
+# options that can be set from a JSON config file and how to convert their values
+_CONFIG_FIELDS = (
+    ("username", str),
+    ("port", int),
+    ("public_key_str", str),
+    ("container_image", str),
+    ("gpus", str),
+    ("dry_run", bool),
+    ("reverse_proxy_host", str),
+    ("extra_docker_run_args", str),
+)
+
+# shell scripts written into every connection directory, filled in with str.format_map
+SCRIPTS = {
+    # ssh screen for reverse port forwarding
+    "ssh_reverse_tunnel.sh": """#!/usr/bin/env bash
+while true; do
+ssh -o ExitOnForwardFailure=yes -N -R 0.0.0.0:{port}:localhost:{port} {reverse_proxy_host}
+done
+""",
+    # run container script
+    "start_container.sh": """#!/usr/bin/env bash
+docker run -d {extra_memory_spec} -p {port}:22 {gpu_spec} {extra_docker_run_args} --name {dir_key} {dir_key} || docker restart {dir_key}
+[[ "{reverse_proxy_host}" != "" ]] && ssh {reverse_proxy_host} 'ufw allow {port}/tcp'
+[[ "{reverse_proxy_host}" != "" ]] && screen -S {dir_key}_port_forward -d -m ./ssh_reverse_tunnel.sh
+echo "Container started"
+""",
+    # stop container script
+    "stop_container.sh": """#!/usr/bin/env bash
+docker stop {dir_key} || docker kill {dir_key}
+[[ "{reverse_proxy_host}" != "" ]] && ssh {reverse_proxy_host} 'ufw delete allow {port}/tcp'
+[[ "{reverse_proxy_host}" != "" ]] && screen -X -S {dir_key}_port_forward quit
+echo "Container stopped"
+""",
+}
+
+
+@functools.cache
+def base_port() -> int:
+    # imported here, since they are only needed when a port has to be picked
+    from hashlib import sha512
+    from socket import gethostname
+
+    # the base port is a 10 digit wide default starting port for containers
+    # it's based on the first 8 bytes (modulo 1000) of the sha512 hash of the hostname
+    return (
+        int.from_bytes(sha512(gethostname().encode("utf-8")).digest()[:8], "little") % 1000
+    ) * 10 + 32000
+
+
+@functools.cache
+def dockerfile_template() -> str:
+    # read once per process, it is written into every connection directory
+    return (ROOT_DIR / "Dockerfile.template").read_text()
 
 
 def parse_arguments():
@@ -54,8 +102,16 @@ def parse_arguments():
     parser.add_argument(
         "--config",
         type=str,
-        default="",
-        help="Path to a JSON config file as an alternative to command line arguments.",
+        nargs="+",
+        default=[],
+        help="Path to a JSON config file as an alternative to command line arguments. "
+        + "Several files create one container per file.",
+    )
+    parser.add_argument(
+        "--proc",
+        type=int,
+        default=1,
+        help="Number of docker builds to run in parallel when several configs are given.",
     )
     parser.add_argument(
         "--extra-docker-run-args",
@@ -64,154 +120,158 @@ def parse_arguments():
         help="Extra arguments to pass to docker run -- when creating the persistent container.",
     )
     args = parser.parse_args()
-    if args.config != "" and Path(args.config).is_file():
-        config = json.loads(Path(args.config).read_text())
-        # username
-        if "username" in config:
-            args.username = config["username"]
-        # port
-        if "port" in config:
-            args.port = int(config["port"])
-        # the public key
-        if "public_key_str" in config:
-            args.public_key_str = config["public_key_str"]
-        if "public-key-str" in config:
-            args.public_key_str = config["public-key-str"]
-        # container name
-        if "container_image" in config:
-            args.container_image = config["container_image"]
-        if "container-image" in config:
-            args.container_image = config["container-image"]
-        # gpus flag
-        if "gpus" in config:
-            args.gpus = config["gpus"]
-        # dry run
-        if "dry_run" in config:
-            args.dry_run = config["dry_run"]
-        # reverse proxy
-        if "reverse_proxy_host" in config:
-            args.reverse_proxy_host = config["reverse_proxy_host"]
-        if "reverse-proxy-host" in config:
-            args.reverse_proxy_host = config["reverse-proxy-host"]
-        # extra docker args
-        if "extra_docker_run_args" in config:
-            args.extra_docker_run_args = config["extra_docker_run_args"]
-        if "extra-docker-run-args" in config:
-            args.extra_docker_run_args = config["extra-docker-run-args"]
-    assert args.username != "", "Username must be specified"
-    assert args.public_key_str != "", "Public key string must be specified"
-    return args
-
-
-def resolve_port(args: Namespace) -> bool:
-    # ports = SqliteDict("users.sqlite", autocommit=True)
-    all_ports = dict(
-        [
-            list(re.match(r"(.*?)_(\d+)$", fname).groups())[::-1]
-            for fname in os.listdir(ROOT_DIR / "connections")
-            if re.match(r"(.*?)_\d+$", fname) is not None
-        ]
-    )
-    all_ports = {int(k): v for (k, v) in all_ports.items()}
+    all_args = []
+    for config_path in args.config or [""]:
+        user_args = Namespace(**vars(args))
+        try:
+            config_text = Path(config_path).read_bytes() if config_path != "" else None
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            config_text = None
+        if config_text is not None:
+            config = json.loads(config_text)
+            # accept both spellings of the option names, the hyphenated one takes precedence
+            config = {
+                **{k: v for k, v in config.items() if "-" not in k},
+                **{k.replace("-", "_"): v for k, v in config.items() if "-" in k},
+            }
+            for name, coerce in _CONFIG_FIELDS:
+                if name in config:
+                    setattr(user_args, name, coerce(config[name]))
+        assert user_args.username != "", "Username must be specified"
+        assert user_args.public_key_str != "", "Public key string must be specified"
+        all_args.append(user_args)
+    return all_args
+
+
+def _scan_connections() -> dict:
+    # map of ports to usernames from the connections/<username>_<port> directories
+    all_ports = {}
+    with os.scandir(ROOT_DIR / "connections") as it:
+        for entry in it:
+            user, sep, port = entry.name.rpartition("_")
+            if sep and port.isdecimal():
+                all_ports[int(port)] = user
+    return all_ports
+
+
+def resolve_port(args: Namespace, reserved: Optional[set] = None) -> str:
+    # reserved are the ports picked earlier in this run, not yet on disk
+    reserved = set() if reserved is None else reserved
     if args.port < 0:
-        port_list = list(all_ports.keys()) + [BASE_PORT]
-        # port_list = [int(k) for k in ports.keys()] + [default_port]
-        args.port = (max(*port_list) if len(port_list) > 1 else BASE_PORT) + 1
-    if args.port in all_ports:
-        if all_ports[args.port] == args.username:
+        # a port above all existing ones cannot be in use
+        default_port = base_port()
+        port_list = list(_scan_connections().keys()) + list(reserved) + [default_port]
+        args.port = max(port_list) + 1
+        return "not_in_use"
+    if args.port in reserved:
+        return "in_use_by_this_run"
+    hits = list((ROOT_DIR / "connections").glob(f"*_{args.port}"))
+    if len(hits) > 0:
+        if hits[0].name.rpartition("_")[0] == args.username:
             print("Port already in use by this user")
             return "in_use_by_user"
         else:
             return "in_use_by_another"
-    # ports[args.port] = args.username
     return "not_in_use"
 
 
+def write_script(path: Path, text: str) -> None:
+    # create the file executable directly, fchmod since the umask applies to os.open's mode
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o755)
+    os.fchmod(fd, 0o755)
+    with os.fdopen(fd, "w") as f:
+        f.write(text)
+
+
 ####################################################################################################
 ####################################################################################################
 ####################################################################################################
 
 
-def main():
-    args = parse_arguments()
-    port_status = resolve_port(args)
+def check_container(args: Namespace, reserved: Optional[set] = None) -> Optional[str]:
+    # resolves the port and asks about overwriting, without writing anything yet
+    port_status = resolve_port(args, reserved)
     if port_status == "in_use_by_another":
         raise ValueError("Port already in use by another user")
+    if port_status == "in_use_by_this_run":
+        raise ValueError(f"Port {args.port} is given by more than one config")
 
-    # make the directory  ###########################################
     dir_key = f"{args.username}_{args.port}".replace(" ", "_")
-    storage_dir = ROOT_DIR / "connections"
-    if (storage_dir / dir_key).exists():
-        decision = input("Directory already exists. Overwrite? [y/n] ")
-        while True:
-            if decision.lower() == "n":
-                print("Doing nothing, exiting.")
-                return
-            if decision.lower() in ("y", "yes"):
-                try:
-                    check_call([str(storage_dir / dir_key / "stop_container.sh")])
-                except Exception:
-                    pass
-                rmtree(storage_dir / dir_key)
-                break
-    os.mkdir(storage_dir / dir_key)
-    copyfile(ROOT_DIR / "Dockerfile.template", storage_dir / dir_key / "Dockerfile")
-
-    os.chdir(storage_dir / dir_key)
-    Path(storage_dir / dir_key / "authorized_keys").write_text(args.public_key_str)
-    gpu_spec = "" if args.gpus == "" else f"--gpus {args.gpus}"
-
-    # ssh screen for reverse port forwarding ######################
-    if args.reverse_proxy_host != "":
-        Path(storage_dir / dir_key / "ssh_reverse_tunnel.sh").write_text(
-            f"""#!/usr/bin/env bash
-while true; do
-ssh -o ExitOnForwardFailure=yes -N -R 0.0.0.0:{args.port}:localhost:{args.port} {args.reverse_proxy_host}
-done
-            """
-        )
-        check_call(["chmod", "+x", storage_dir / dir_key / "ssh_reverse_tunnel.sh"])
-
-    # run container script ########################################
-    # allows computational processes to work well with multiprocessing
-    extra_memory_spec = "--ipc=host --ulimit memlock=-1 --ulimit stack=67108864"
-    Path(storage_dir / dir_key / "start_container.sh").write_text(
-        f"""#!/usr/bin/env bash
-docker run -d {extra_memory_spec} -p {args.port}:22 {gpu_spec} {args.extra_docker_run_args} --name {dir_key} {dir_key} || docker restart {dir_key}
-[[ "{args.reverse_proxy_host}" != "" ]] && ssh {args.reverse_proxy_host} 'ufw allow {args.port}/tcp'
-[[ "{args.reverse_proxy_host}" != "" ]] && screen -S {dir_key}_port_forward -d -m ./ssh_reverse_tunnel.sh
-echo "Container started"
-        """
-    )
-    check_call(["chmod", "+x", storage_dir / dir_key / "start_container.sh"])
+    if (ROOT_DIR / "connections" / dir_key).exists():
+        decision = input("Directory already exists. Overwrite? [y/n] ").strip().lower()
+        if decision == "n":
+            print(f"Skipping {dir_key}.")
+            return None
+        if decision not in ("y", "yes"):
+            raise SystemExit("Aborting.")
+    return dir_key
 
-    # stop container script #######################################
-    Path(storage_dir / dir_key / "stop_container.sh").write_text(
-        f"""#!/usr/bin/env bash
-docker stop {dir_key} || docker kill {dir_key}
-[[ "{args.reverse_proxy_host}" != "" ]] && ssh {args.reverse_proxy_host} 'ufw delete allow {args.port}/tcp'
-[[ "{args.reverse_proxy_host}" != "" ]] && screen -X -S {dir_key}_port_forward quit
-echo "Container stopped"
-        """
+
+def prepare_container(dir_key: str, args: Namespace) -> None:
+    # make the directory  ###########################################
+    target = ROOT_DIR / "connections" / dir_key
+    if target.exists():
+        try:
+            check_call([str(target / "stop_container.sh")])
+        except Exception:
+            pass
+        rmtree(target)
+    os.mkdir(target)
+
+    # (file name, contents, whether the file is an executable script)
+    files = [
+        ("Dockerfile", dockerfile_template(), False),
+        ("authorized_keys", args.public_key_str, False),
+    ]
+    ctx = dict(
+        port=args.port,
+        dir_key=dir_key,
+        reverse_proxy_host=args.reverse_proxy_host,
+        gpu_spec="" if args.gpus == "" else f"--gpus {args.gpus}",
+        extra_docker_run_args=args.extra_docker_run_args,
+        # allows computational processes to work well with multiprocessing
+        extra_memory_spec="--ipc=host --ulimit memlock=-1 --ulimit stack=67108864",
     )
-    check_call(["chmod", "+x", storage_dir / dir_key / "stop_container.sh"])
+    for name, template in SCRIPTS.items():
+        # the reverse tunnel is only needed with a reverse proxy host
+        if name == "ssh_reverse_tunnel.sh" and args.reverse_proxy_host == "":
+            continue
+        files.append((name, template.format_map(ctx), True))
+
+    for name, content, executable in files:
+        path = target / name
+        if executable:
+            write_script(path, content)
+        else:
+            path.write_text(content)
+
+
+def _build_and_run(dir_key: str, args: Namespace) -> None:
+    target = ROOT_DIR / "connections" / dir_key
+    prepare_container(dir_key, args)
 
     # build the docker container ##################################
-    check_call(
-        [
-            "docker",
-            "build",
-            "--build-arg",
-            f"USERNAME={args.username}",
-            "--build-arg",
-            f"CONTAINER_VERSION={args.container_image}",
-            "-t",
-            dir_key,
-            ".",
-        ]
-    )
+    try:
+        check_call(
+            [
+                "docker",
+                "build",
+                "--build-arg",
+                f"USERNAME={args.username}",
+                "--build-arg",
+                f"CONTAINER_VERSION={args.container_image}",
+                "-t",
+                dir_key,
+                ".",
+            ],
+            cwd=target,
+        )
+    except Exception:
+        # nothing was built, do not leave a connection directory behind for it
+        rmtree(target)
+        raise
     if not args.dry_run:
-        check_call(["./start_container.sh"])
+        check_call(["./start_container.sh"], cwd=target)
     print()
     print()
     print(f"Created a container for user {args.username} on port {args.port}")
@@ -219,5 +279,37 @@ echo "Container stopped"
     print()
 
 
+def main():
+    all_args = parse_arguments()
+    # every config is checked before anything is written, ports picked for earlier configs
+    # are reserved for the later ones
+    tasks, reserved = [], set()
+    for args in all_args:
+        dir_key = check_container(args, reserved)
+        reserved.add(args.port)
+        if dir_key is not None:
+            tasks.append((dir_key, args))
+
+    # a failing config does not stop the others, failures are reported at the end
+    failures = []
+    proc = all_args[0].proc
+    if proc > 1 and len(tasks) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=proc) as ex:
+            futures = [ex.submit(_build_and_run, dir_key, args) for dir_key, args in tasks]
+            for (dir_key, _), future in zip(tasks, futures):
+                if future.exception() is not None:
+                    failures.append(f"{dir_key}: {future.exception()}")
+    else:
+        for dir_key, args in tasks:
+            try:
+                _build_and_run(dir_key, args)
+            except Exception as e:
+                failures.append(f"{dir_key}: {e}")
+    if len(failures) > 0:
+        raise SystemExit("Failed to create:\n" + "\n".join(failures))
+
+
 if __name__ == "__main__":
     main()